@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from email.message import EmailMessage
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
+import orjson
 import requests
-from jinja2 import Template
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache, select_autoescape
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import config
 import logging
+import os
+import re
 import sys
+import tempfile
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,11 +24,135 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
+TEMPLATE_SRC = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body { font-family: Arial, sans-serif; max-width: 1000px; margin: 0 auto; padding: 20px; }
+        .species-card { border: 1px solid #ddd; border-radius: 8px; padding: 20px; margin-bottom: 20px; }
+        .species-header { display: flex; gap: 20px; margin-bottom: 15px; }
+        .species-image { width: 150px; height: 150px; object-fit: cover; border-radius: 8px; margin-right: 20px; }
+        .species-info { flex: 1; }
+        .species-name { font-size: 20px; font-weight: bold; margin-bottom: 5px; }
+        .scientific-name { font-style: italic; color: #666; }
+        .grid-header { display: flex; gap: 2px; margin-bottom: 4px; }
+        .hour-label { width: 25px; text-align: center; font-size: 11px; color: #666; }
+        .sound-link { display: inline-block; margin-top: 10px; color: #0066cc; text-decoration: none; }
+    </style>
+</head>
+<body>
+    <h1>Bird Detection Report - Past {{ hours }} Hours</h1>
+    <h2>{{ species_list|length }} Species, {{ species_list|sum(attribute='count') }} Total Detections</h2>
+    <p>Generated on {{ generated_on }} from <a href="{{ friendly_url }}">BirdWeather station {{config.STATION_TOKEN}}</a></p>
+    {% for species in species_list %}
+    <div class="species-card">
+        <div class="species-header">
+            {% if species.image_url %}
+            <img src="{{ species.image_url }}" alt="{{ species.name }}" class="species-image">
+            {% endif %}
+            <span class="species-info">
+                <span class="species-name"><b>{{ species.name }}</b></span> -
+                <span class="scientific-name"><i>{{ species.scientific_name }}</i></span><br>
+                <span>Detections: {{ species.count }}.</span> &nbsp;
+                <span>Highest confidence: {{ "%.1f"|format(species.max_confidence * 100) }}%.</span>
+                {% if species.best_soundscape %}
+                <br><a href="{{ species.best_soundscape.url }}" class="sound-link">
+                    Listen to best detection ({{ "%.1f"|format(species.best_soundscape.startTime) }}s - {{ "%.1f"|format(species.best_soundscape.endTime) }}s)
+                </a>
+                {% endif %}
+            </span>
+        </div>
+        
+        <div>
+            <div class="grid-header">
+                {% for hour in species.hours %}
+                <span class="hour-label" style="background-color: {{ hour.color }};" title="{{ hour.count }} detections">{{hour.hour}}</span>
+                {% endfor %}
+            </div>
+        </div>
+    </div>
+    &nbsp;
+    {% endfor %}
+</body>
+</html>
+"""
+# Drop indentation and blank lines, but keep line breaks so that lines in
+# the 8bit-encoded email stay well under the SMTP line length limit.
+TEMPLATE_SRC = re.sub(r'\n\s+', '\n', TEMPLATE_SRC)
+
+# Templates created with from_string() bypass the bytecode cache, so the
+# source is served through a loader to let later runs skip compilation.
+# With no arguments the cache lives in a per-user, mode 0700 directory.
+_ENV = Environment(
+    loader=DictLoader({"report.html": TEMPLATE_SRC}),
+    autoescape=select_autoescape(['html']),
+    trim_blocks=True,
+    lstrip_blocks=True,
+    bytecode_cache=FileSystemBytecodeCache()
+)
+_REPORT_TEMPLATE = _ENV.get_template("report.html")
+
+_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "birdweather")
+
+def _parse_timestamp(timestamp):
+    # fromisoformat() only accepts a trailing 'Z' from Python 3.11 on.
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+def _load_cached_detections(path, from_time):
+    """Return the cached detections inside the window, newest first.
+
+    Returns an empty list if there is no usable cache, or if the cache was
+    written for a window starting after from_time, since it would then be
+    missing the oldest detections.
+    """
+    from_dt = _parse_timestamp(from_time)
+    try:
+        with open(path, 'rb') as f:
+            cached = orjson.loads(f.read())
+        if _parse_timestamp(cached['from']) > from_dt:
+            return []
+        detections = cached['detections']
+        # Detections are newest first, so only those that have dropped out
+        # of the window need their timestamps parsed.
+        while detections and _parse_timestamp(detections[-1]['timestamp']) < from_dt:
+            detections.pop()
+        return detections
+    except (OSError, ValueError, KeyError):
+        return []
+
+def _save_cached_detections(path, from_time, detections):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            f.write(orjson.dumps({'from': from_time, 'detections': detections}))
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
 def fetch_bird_detections(hours=24):
-    detections = []
+    """Yield pages of detections from the past hours, newest first.
+
+    Detections from earlier runs are kept in a per-station cache, and only
+    those newer than the newest cached one are downloaded.  The cache is
+    rewritten with just the detections inside the current window.
+    """
     now = datetime.now(timezone.utc)
     from_time = (now - timedelta(hours=hours)).isoformat()
-    logging.info(f"Fetching detections from {from_time}")
+    logging.info("Fetching detections from %s", from_time)
+    
+    cache_path = os.path.join(_CACHE_DIR, f"{config.STATION_TOKEN}.json")
+    cached = _load_cached_detections(cache_path, from_time)
+    # Detection ids increase over time, so anything with an id at or below
+    # the newest cached one has already been seen.
+    newest_cached_id = cached[0]['id'] if cached else 0
+    fetched = []
+    complete = False
     
     url = f"https://app.birdweather.com/api/v1/stations/{config.STATION_TOKEN}/detections"
     params = {
@@ -31,124 +161,97 @@ def fetch_bird_detections(hours=24):
         "order": "desc"
     }
     
-    while True:
-        response = requests.get(url, params=params)
-        data = response.json()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+    with requests.Session() as session:
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        # requests already sends Accept-Encoding: gzip, deflate.
+        session.headers["Accept"] = "application/json"
+        
+        # The cursor for each page is the id of the last detection on the
+        # previous one, and ids are not contiguous, so pages can't be prefetched.
+        while True:
+            data = orjson.loads(session.get(url, params=params).content)
         
-        if not data['success'] or not data['detections']:
-            break
+            if not data['success']:
+                break
+            if not data['detections']:
+                complete = True
+                break
             
-        logging.info(f"Fetched {len(data['detections'])} detections")
+            logging.info("Fetched %d detections", len(data['detections']))
             
-        detections.extend(data['detections'])
-        last_id = data['detections'][-1]['id']
+            page = data['detections']
+            last_id = page[-1]['id']
+            if last_id <= newest_cached_id:
+                page = [d for d in page if d['id'] > newest_cached_id]
+            if page:
+                fetched.extend(page)
+                yield page
         
-        if len(data['detections']) < 100:
-            break
+            if len(data['detections']) < 100 or last_id <= newest_cached_id:
+                complete = True
+                break
             
-        params['cursor'] = last_id
+            params['cursor'] = last_id
     
-    return detections
+    if cached:
+        yield cached
+    # A failed request leaves a gap between the fetched and cached detections.
+    if complete:
+        # The cache is only a speed-up, so failing to write it isn't fatal.
+        try:
+            _save_cached_detections(cache_path, from_time, fetched + cached)
+        except OSError as e:
+            logging.warning("Could not write detection cache %s: %s", cache_path, e)
 
 def generate_report(hours=24):
-    detections = fetch_bird_detections(hours)
     species_stats = defaultdict(lambda: {
         'count': 0,
         'max_confidence': 0,
-        'hour_counts': defaultdict(int),
+        'hour_counts': [0] * 24,
         'scientific_name': None,
         'image_url': None,
         'best_soundscape': None
     })
     
-    for detection in detections:
-        common_name = detection['species']['commonName']
-        hour = datetime.fromisoformat(detection['timestamp']).replace(tzinfo=None).hour
-        stats = species_stats[common_name]
-        stats['count'] += 1
-        stats['scientific_name'] = detection['species']['scientificName']
-        stats['image_url'] = detection['species']['imageUrl']
+    for page in fetch_bird_detections(hours):
+        for detection in page:
+            species = detection['species']
+            # Timestamps are in the station's local time, e.g.
+            # 2024-05-01T06:12:34.000-04:00, so the local hour is at [11:13].
+            hour = int(detection['timestamp'][11:13])
+            stats = species_stats[species['commonName']]
+            stats['count'] += 1
+            if stats['scientific_name'] is None:
+                stats['scientific_name'] = species['scientificName']
+                stats['image_url'] = species['imageUrl']
         
-        confidence = detection['confidence']
-        if confidence > stats['max_confidence']:
-            stats['max_confidence'] = confidence
-            stats['best_soundscape'] = detection['soundscape']
+            confidence = detection['confidence']
+            if confidence > stats['max_confidence']:
+                stats['max_confidence'] = confidence
+                stats['best_soundscape'] = detection['soundscape']
             
-        stats['hour_counts'][hour] += 1
+            stats['hour_counts'][hour] += 1
     
+    for name, stats in species_stats.items():
+        stats['name'] = name
     sorted_species = sorted(
-        [{'name': k, **v} for k, v in species_stats.items()],
+        species_stats.values(),
         key=lambda x: x['count'],
         reverse=True
     )
     
     for species in sorted_species:
-        species['hours'] = [
-            {
+        species['hours'] = []
+        for hour, count in enumerate(species['hour_counts']):
+            shade = 255 - min(count * 25, 255)
+            species['hours'].append({
                 'hour': hour,
-                'count': species['hour_counts'].get(hour, 0),
-                'intensity': min(species['hour_counts'].get(hour, 0) * 25, 255)
-            }
-            for hour in range(24)
-        ]
-    
-    template = Template("""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 1000px; margin: 0 auto; padding: 20px; }
-            .species-card { border: 1px solid #ddd; border-radius: 8px; padding: 20px; margin-bottom: 20px; }
-            .species-header { display: flex; gap: 20px; margin-bottom: 15px; }
-            .species-image { width: 150px; height: 150px; object-fit: cover; border-radius: 8px; margin-right: 20px; }
-            .species-info { flex: 1; }
-            .species-name { font-size: 20px; font-weight: bold; margin-bottom: 5px; }
-            .scientific-name { font-style: italic; color: #666; }
-            .hour-grid { display: flex; gap: 2px; margin-top: 10px; }
-            .hour-cell { width: 25px; height: 25px; border: 1px solid #eee; }
-            .grid-header { display: flex; gap: 2px; margin-bottom: 4px; }
-            .hour-label { width: 25px; text-align: center; font-size: 11px; color: #666; }
-            .sound-link { display: inline-block; margin-top: 10px; color: #0066cc; text-decoration: none; }
-        </style>
-    </head>
-    <body>
-        <h1>Bird Detection Report - Past {{ hours }} Hours</h1>
-        <h2>{{ species_list|length }} Species, {{ species_list|sum(attribute='count') }} Total Detections</h2>
-        <p>Generated on {{ generated_on }} from <a href="{{ friendly_url }}">BirdWeather station {{config.STATION_TOKEN}}</a></p>
-        {% for species in species_list %}
-        <div class="species-card">
-            <div class="species-header">
-                {% if species.image_url %}
-                <img src="{{ species.image_url }}" alt="{{ species.name }}" class="species-image">
-                {% endif %}
-                <span class="species-info">
-                    <span class="species-name"><b>{{ species.name }}</b></span> -
-                    <span class="scientific-name"><i>{{ species.scientific_name }}</i></span><br>
-                    <span>Detections: {{ species.count }}.</span> &nbsp;
-                    <span>Highest confidence: {{ "%.1f"|format(species.max_confidence * 100) }}%.</span>
-                    {% if species.best_soundscape %}
-                    <br><a href="{{ species.best_soundscape.url }}" class="sound-link">
-                        Listen to best detection ({{ "%.1f"|format(species.best_soundscape.startTime) }}s - {{ "%.1f"|format(species.best_soundscape.endTime) }}s)
-                    </a>
-                    {% endif %}
-                </span>
-            </div>
-            
-            <div>
-                <div class="grid-header">
-                    {% for hour in species.hours %}
-                    <span class="hour-label" style="background-color: rgb({{ 255 - hour.intensity }}, 255, {{ 255 - hour.intensity }});" title="{{ hour.count }} detections">{{hour.hour}}</span>
-                    {% endfor %}
-                </div>
-            </div>
-        </div>
-        &nbsp;
-        {% endfor %}
-    </body>
-    </html>
-    """)
+                'count': count,
+                'color': f"rgb({shade}, 255, {shade})"
+            })
     
-    return template.render(
+    return _REPORT_TEMPLATE.render(
         species_list=sorted_species,
         hours=hours,
         generated_on=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -156,17 +259,37 @@ def generate_report(hours=24):
         config=config
     )
 
-def send_email(html_content):
-    msg = MIMEMultipart('alternative')
+def _open_smtp():
+    server = smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT)
+    try:
+        server.starttls()
+        server.login(config.EMAIL_FROM, config.EMAIL_PASSWORD)
+    except BaseException:
+        server.close()
+        raise
+    return server
+
+def _smtp_alive(server):
+    try:
+        return server.noop()[0] == 250
+    except smtplib.SMTPServerDisconnected:
+        return False
+
+def send_email(html_content, server):
+    msg = EmailMessage()
     msg['Subject'] = "BirdWeather Report 🦉"
     msg['From'] = config.EMAIL_FROM
     msg['To'] = config.EMAIL_TO
-    msg.attach(MIMEText(html_content, 'html'))
 
-    with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as server:
-        server.starttls()
-        server.login(config.EMAIL_FROM, config.EMAIL_PASSWORD)
-        server.sendmail(config.EMAIL_FROM, config.EMAIL_TO, msg.as_string())
+    with server:
+        # Raw 8bit bodies must be declared with BODY=8BITMIME, which only
+        # servers advertising the extension accept.
+        if server.has_extn('8bitmime'):
+            msg.set_content(html_content, subtype='html', cte='8bit')
+            server.send_message(msg, mail_options=['BODY=8BITMIME'])
+        else:
+            msg.set_content(html_content, subtype='html', cte='quoted-printable')
+            server.send_message(msg)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate bird detection report')
@@ -174,8 +297,25 @@ if __name__ == "__main__":
                       help='Number of hours to include in report (default: 24)')
     args = parser.parse_args()
     
-    logging.info(f"Starting report generation for past {args.hours} hours")
-    html_report = generate_report(args.hours)
-    logging.info("Generated HTML report, sending email")
-    send_email(html_report)
+    logging.info("Starting report generation for past %d hours", args.hours)
+    # Connect and log in to the SMTP server while the report is generated.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        smtp_future = executor.submit(_open_smtp)
+        try:
+            html_report = generate_report(args.hours)
+        except BaseException:
+            try:
+                smtp_future.result().quit()
+            except Exception:
+                pass
+            raise
+        logging.info("Generated HTML report, sending email")
+        # The connection sits idle for the whole fetch, and a long --hours run
+        # can outlast the server's idle timeout (about 5 minutes per RFC 5321).
+        server = smtp_future.result()
+        if not _smtp_alive(server):
+            logging.info("SMTP connection timed out, reconnecting")
+            server.close()
+            server = _open_smtp()
+        send_email(html_report, server)
     logging.info("Email sent successfully")